@@ -4,7 +4,7 @@
 resync_cmd = 'resync.py'
 
 
-import sys, os, subprocess, pathlib, tempfile, shutil, argparse, json
+import sys, os, subprocess, pathlib, tempfile, shutil, argparse, json, shlex
 
 parser = argparse.ArgumentParser(description='Relay documents over your reMarkable for signing')
 parser.add_argument('-r', '--remote-address', action='store', default='10.11.99.1', dest='ssh_destination', metavar='<IP or hostname>', help='remote address of the reMarkable')
@@ -14,10 +14,20 @@ args = parser.parse_args()
 
 prepdir = pathlib.Path(tempfile.mkdtemp())
 ssh_socketfile = '/tmp/remarkable-push.socket'
-ssh_connection = subprocess.Popen(f'ssh -o ConnectTimeout=1 -M -N -q -S {ssh_socketfile} root@{args.ssh_destination}', shell=True)
+ssh_command = ['ssh', '-S', ssh_socketfile, f'root@{args.ssh_destination}']
+ssh_connection = subprocess.Popen(['ssh', '-o', 'ConnectTimeout=1', '-M', '-N', '-q', '-S', ssh_socketfile, f'root@{args.ssh_destination}'])
+
+
+def ssh_output(cmd):
+    """
+    runs cmd on the remarkable and returns its combined output, without going through a local shell
+    """
+    res = subprocess.run([*ssh_command, cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return res.stdout.rstrip('\n')
+
 
 # quickly check if we actually have a functional ssh connection (might not be the case right after an update)
-checkmsg = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "/bin/true"')
+checkmsg = ssh_output("/bin/true")
 if checkmsg != "":
     print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation with:")
     print(checkmsg)
@@ -65,9 +75,9 @@ def get_uuid_by_visibleName(name):
     """
     retrieves uuid for all given documents that have the given name set as visibleName
     """
-    #pattern = f'"visibleName": "{name}"'
-    cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "grep -lF \'\\"visibleName\\": \\"{name}\\"\' .local/share/remarkable/xochitl/*.metadata"'
-    res = subprocess.getoutput(cmd)
+    # resync.py writes compact metadata, xochitl an indented one
+    patterns = [f'"visibleName":"{name}"', f'"visibleName": "{name}"']
+    res = ssh_output("grep -lF " + " ".join(f"-e {shlex.quote(p)}" for p in patterns) + " .local/share/remarkable/xochitl/*.metadata")
 
     uuid_candidates = []
     if res != '':
@@ -80,7 +90,7 @@ def get_uuid_by_visibleName(name):
 
             u, _ = filename.split('.')
 
-            raw_metadata = subprocess.getoutput(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "cat .local/share/remarkable/xochitl/{u}.metadata"')
+            raw_metadata = ssh_output(f'cat .local/share/remarkable/xochitl/{u}.metadata')
 
             try:
                 metadata = json.loads(raw_metadata)
@@ -103,9 +113,8 @@ def get_uuid_by_visibleName(name):
 for tf in targetfiles:
     u = get_uuid_by_visibleName(tf)
     if u is not None:
-        cmd = f'ssh -S {ssh_socketfile} root@{args.ssh_destination} "rm -r ~/.local/share/remarkable/xochitl/{u}*"'
-        subprocess.call(cmd, shell=True)
+        subprocess.call([*ssh_command, f'rm -r ~/.local/share/remarkable/xochitl/{u}*'])
 
-subprocess.call(f'ssh -S {ssh_socketfile} root@{args.ssh_destination} systemctl restart xochitl', shell=True)
+subprocess.call([*ssh_command, 'systemctl restart xochitl'])
 ssh_connection.terminate()
 print("All documents processed, have fun with your remaining paperwork. :)")
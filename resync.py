@@ -9,20 +9,37 @@ import shutil
 import argparse
 import uuid
 import subprocess
+import shlex
 import tempfile
 import pathlib
-import urllib.request
 import re
-import io
+import tarfile
+import functools
+import collections
+import concurrent.futures
 import tqdm
+import requests
 import ipaddress
 
+try:
+    # considerably faster on the many small metadata files
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 default_prepdir = tempfile.mkdtemp(prefix="resync")
 
-ssh_socketfile = '/tmp/remarkable-push.socket'
+# unique per process, so that concurrent runs (e.g. from resign.py) do not fight over the master connection
+ssh_socketfile = f'/tmp/resync-{os.getpid()}.sock'
 
 xochitl_dir = '~/.local/share/remarkable/xochitl'
 
+# metadata retrieved in earlier runs, revalidated against the modification times and sizes on the device
+cache_dir = pathlib.Path(os.environ.get('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'remarkable-resync'
+
+# shared by the download workers so that the connections to the web interface are kept alive
+session = requests.Session()
+
 parser = argparse.ArgumentParser(description='Push and pull files to and from your reMarkable',
                                  formatter_class=argparse.RawTextHelpFormatter)
 
@@ -61,6 +78,8 @@ parser.add_argument('-r', '--remote-address', action='store', default='10.11.99.
                     help='remote address of the reMarkable')
 parser.add_argument('--transfer-dir', metavar='<directory name>', dest='prepdir', type=str, default=default_prepdir,
                     help='custom directory to render files to-be-upload')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=8, metavar='<number>',
+                    help='number of documents downloaded concurrently in the pull and backup modes (default: 8)')
 parser.add_argument('--debug', dest='debug', action='store_true', default=False,
                     help="Render documents, but don't copy to remarkable.")
 parser.add_argument('-y', '--yes', dest='yes', action='store_true', default=False,
@@ -83,6 +102,12 @@ parser.add_argument('documents', metavar='documents', type=str, nargs='*',
 
 args = parser.parse_args()
 
+if args.jobs < 1:
+    parser.error("argument -j/--jobs: must be at least 1")
+
+# one pooled connection per download worker; requests keeps only 10 by default
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.jobs))
+
 if args.mode == '+':
     args.mode = 'push'
 elif args.mode == '-':
@@ -98,24 +123,29 @@ except ValueError as e:
     pass
 
 
-ssh_command = " ".join(
-    ["ssh",
-     "-o PubkeyAcceptedKeyTypes=+ssh-rsa",
-     "-o HostKeyAlgorithms=+ssh-rsa",
-     "-o UserKnownHostsFile=/dev/null",
-     "-o StrictHostKeyChecking=no",
-     "-o ConnectTimeout=1",
-     f"-S {ssh_socketfile}",])
-
-
-def ssh(arg,dry=False,status=False):
+ssh_command = [
+    "ssh",
+    "-o", "PubkeyAcceptedKeyTypes=+ssh-rsa",
+    "-o", "HostKeyAlgorithms=+ssh-rsa",
+    "-o", "UserKnownHostsFile=/dev/null",
+    "-o", "StrictHostKeyChecking=no",
+    "-o", "ConnectTimeout=1",
+    "-o", "ControlMaster=auto",
+    "-o", "ControlPersist=60s",
+    "-o", f"ControlPath={ssh_socketfile}",
+]
+
+
+def ssh(arg,dry=False,input=None):
+    # no local shell involved: arg reaches the remote shell as is; input is fed to its stdin.
+    # without input, stdin is /dev/null rather than the terminal: the master would otherwise read it
+    # and swallow the answers to ask() while a call runs in the background
+    command = [*ssh_command, args.host, arg]
     if args.verbosity >= 1:
-        print(f'{ssh_command} {args.host} \'{arg}\'')
+        print(" ".join(shlex.quote(c) for c in command))
     if not dry:
-        if status:
-            return subprocess.getstatusoutput(f'{ssh_command} {args.host} \'{arg}\'')
-        else:
-            return subprocess.getoutput(f'{ssh_command} {args.host} \'{arg}\'')
+        return subprocess.run(command, input=input, stdin=subprocess.DEVNULL if input is None else None,
+                              stdout=subprocess.PIPE, text=True).stdout.rstrip("\n")
 
 
 class FileCollision(Exception):
@@ -124,6 +154,9 @@ class FileCollision(Exception):
 class ShouldNeverHappenError(Exception):
     pass
 
+class RemoteCommandError(Exception):
+    pass
+
 
 #########################
 #
@@ -173,98 +206,140 @@ def construct_metadata(filetype, name, parent_id=''):
     return meta
 
 
-# from https://stackoverflow.com/questions/6886283/how-i-can-i-lazily-read-multiple-json-values-from-a-file-stream-in-python
-def stream_read_json(f):
-    start_pos = 0
-    while True:
-        try:
-            obj = json.load(f)
-            yield obj
-            return
-        except json.JSONDecodeError as e:
-            f.seek(start_pos)
-            json_str = f.read(e.pos)
-            if json_str == '':
-                return
-            obj = json.loads(json_str)
-            start_pos += e.pos
-            yield obj
-
-
 metadata_by_uuid = {}
-metadata_by_name = {}
-metadata_by_parent = {}
+metadata_by_name = collections.defaultdict(dict)
+metadata_by_parent = collections.defaultdict(dict)
 metadata_by_name_and_parent = {}
 
+def fetch_metadata(names):
+    """
+    retrieves the given metadata files (shell patterns allowed) from the device in a single
+    round trip as one tar stream, yields (uuid, metadata) pairs while it is read
+    """
+    remote = f'cd {xochitl_dir} && tar cf - {" ".join(names)}'
+    command = [*ssh_command, args.host, remote]
+    logmsg(1, " ".join(shlex.quote(c) for c in command))
+    with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE) as proc:
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    yield pathlib.Path(member.name).stem, json_loads(tar.extractfile(member).read())
+        except tarfile.ReadError as e:
+            # an empty or truncated stream; a failing ssh or tar is the likely cause, reported below
+            error = e
+        else:
+            error = None
+        proc.stdout.close()
+        # otherwise a failure on the device would go unnoticed and leave the metadata incomplete
+        if proc.wait() != 0:
+            raise RemoteCommandError(f'"{remote}" failed with exit status {proc.returncode}')
+        if error is not None:
+            raise RemoteCommandError(f'"{remote}" returned an unreadable tar stream: {error}')
+
+
 def retrieve_metadata():
     """
-    retrieves all metadata from the device
+    retrieves all metadata from the device, reusing the cached metadata of files that did not change
     """
     print("retrieving metadata...")
 
-    paths = ssh(f'ls -1 {xochitl_dir}/*.metadata').split("\n")
-    with io.StringIO(ssh(f'cat {xochitl_dir}/*.metadata')) as f:
-        for path, metadata in tqdm.tqdm(zip(paths, stream_read_json(f)), total=len(paths)):
-            path = pathlib.Path(path)
-            if ('deleted' in metadata and metadata['deleted']) or \
-               ('parent' in metadata and metadata['parent'] == 'trash'):
-                continue
-            # metadata["uuid"] = path.stem
-            uuid = path.stem
-            metadata_by_uuid[uuid]                    = metadata
-
-            if metadata["visibleName"] not in metadata_by_name:
-                metadata_by_name[metadata["visibleName"]] = dict()
-            metadata_by_name[metadata["visibleName"]][uuid] = metadata
+    cachefile = cache_dir / f'{args.host}.json'
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {"stamps": {}, "metadata": {}}
+
+    # mtimes only have a resolution of one second, so the size is compared as well;
+    # the device's current time comes first to tell which files may still change within the second.
+    # the listing is checked like the tar stream: read as empty, it would discard the cache and the metadata
+    remote = (f'cd {xochitl_dir} && date +%s && '
+              'set -- *.metadata && if [ -e "$1" ] ; then stat -c "%Y %s %n" "$@" ; fi')
+    command = [*ssh_command, args.host, remote]
+    logmsg(1, " ".join(shlex.quote(c) for c in command))
+    listing = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+    if listing.returncode != 0:
+        raise RemoteCommandError(f'"{remote}" failed with exit status {listing.returncode}')
+    now, *lines = listing.stdout.split("\n")
+    if not now.isdigit():
+        raise RemoteCommandError(f'"{remote}" returned an unexpected listing starting with {now!r}')
+    stamps = {}
+    for line in lines:
+        if line:
+            mtime, size, name = line.split(" ", 2)
+            stamps[pathlib.Path(name).stem] = [int(mtime), int(size)]
+
+    cached_stamps = cache.get("stamps", {})
+    all_metadata = {u: metadata for u, metadata in cache["metadata"].items()
+                    if u in stamps and cached_stamps.get(u) == stamps[u]}
+    stale = [u for u in stamps if u not in all_metadata]
+    logmsg(1, f"{len(all_metadata)} cached, {len(stale)} to retrieve")
+
+    if not all_metadata:
+        # nothing usable in the cache, let the remote shell pick all files
+        batches = [['*.metadata']] if stale else []
+    else:
+        # batched to keep the command line short
+        batchsize = 500
+        batches = [[f'{u}.metadata' for u in stale[i:i+batchsize]] for i in range(0, len(stale), batchsize)]
+
+    with tqdm.tqdm(total=len(stale)) as progress:
+        for batch in batches:
+            for u, metadata in fetch_metadata(batch):
+                all_metadata[u] = metadata
+                progress.update()
+
+    # only reached when the listing and every batch succeeded, a failure raises before the cache is touched
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cachefile, 'w') as f:
+        # files modified in the second of the listing are left out, they are retrieved again next time
+        fresh = [u for u in all_metadata if u in stamps and stamps[u][0] < int(now)]
+        json.dump({"stamps": {u: stamps[u] for u in fresh},
+                   "metadata": {u: all_metadata[u] for u in fresh}}, f)
+
+    for u, metadata in all_metadata.items():
+        if ('deleted' in metadata and metadata['deleted']) or \
+           ('parent' in metadata and metadata['parent'] == 'trash'):
+            continue
+        metadata_by_uuid[u]                    = metadata
 
-            if metadata["parent"] not in metadata_by_parent:
-                metadata_by_parent[metadata["parent"]] = dict()
-            metadata_by_parent[metadata["parent"]][uuid] = metadata
+        metadata_by_name[metadata["visibleName"]][u] = metadata
+        metadata_by_parent[metadata["parent"]][u] = metadata
 
-            if (metadata["visibleName"], metadata["parent"]) in metadata_by_name_and_parent:
-                raise FileCollision(f'Same file name "{metadata["visibleName"]}" under the same parent, not supported! Remove either file! {fullpath(metadata)}')
-            metadata_by_name_and_parent[(metadata["visibleName"], metadata["parent"])] = (uuid, metadata)
-    pass
+        if (metadata["visibleName"], metadata["parent"]) in metadata_by_name_and_parent:
+            raise FileCollision(f'Same file name "{metadata["visibleName"]}" under the same parent, not supported! Remove either file! {fullpath(u)}')
+        metadata_by_name_and_parent[(metadata["visibleName"], metadata["parent"])] = (u, metadata)
 
 
 def get_metadata_by_uuid(u):
     """
     retrieves metadata for a given document identified by its uuid
     """
-    if u in metadata_by_uuid:
-        return metadata_by_uuid[u]
-    else:
-        return None
+    return metadata_by_uuid.get(u)
 
 
 def get_metadata_by_name(name):
     """
     retrieves metadata for all given documents that have the given name set as visibleName
     """
-    if name in metadata_by_name:
-        return metadata_by_name[name]
-    else:
-        return None
+    # .get() does not insert empty entries into the defaultdict
+    return metadata_by_name.get(name)
 
 
 def get_metadata_by_parent(parent):
     """
     retrieves metadata for all given documents that have the given parent
     """
-    if parent in metadata_by_parent:
-        return metadata_by_parent[parent]
-    else:
-        return {}
+    return metadata_by_parent.get(parent, {})
 
 
 def get_metadata_by_name_and_parent(name, parent):
     """
     retrieves metadata for all given documents that have the given parent
     """
-    if (name, parent) in metadata_by_name_and_parent:
-        return metadata_by_name_and_parent[(name, parent)]
-    else:
-        return None
+    return metadata_by_name_and_parent.get((name, parent))
 
 
 
@@ -272,23 +347,38 @@ def remove_uuid(u):
     """note --- not a complete implementation. does not remove from _name and _name_and_parent."""
     metadata = metadata_by_uuid[u]
     del metadata_by_uuid[u]
-    if ("parent" in metadata) and (metadata["parent"] != ""):
+    if "parent" in metadata:
         siblings = metadata_by_parent[metadata["parent"]]
         del siblings[u]
         if not metadata_by_parent[metadata["parent"]]:
             del metadata_by_parent[metadata["parent"]]
+    fullpath.cache_clear()
+
+
+def remove_remote(names, restart=False):
+    """
+    removes the given files (exact names, relative to xochitl_dir) from the device;
+    the names are piped to xargs, which sidesteps ARG_MAX and removes in parallel on the device.
+    with restart, xochitl is restarted afterwards within the same ssh call
+    """
+    logmsg(1, "removing: " + " ".join(names))
+    command = f"cd {xochitl_dir} && tr \"\\n\" \"\\0\" | xargs -0 -n 100 -P 4 rm -rf --"
+    if restart:
+        # ; rather than &&, xochitl needs the restart even if some removal failed
+        command += " ; systemctl restart xochitl"
+    ssh(command, dry=args.dryrun, input="\n".join(names))
 
 
 def curb_tree(node, excludelist):
     """
-    removes nodes from a tree based on a list of exclude patterns;
+    removes nodes from a tree based on a list of compiled exclude patterns;
     returns True if the root node is removed, None otherwise as the
     tree is curbed inplace
     """
-    for exc in excludelist:
-        if re.match(exc, node.get_full_path()) is not None:
-            logmsg(2, "curbing "+node.get_full_path())
-            return True
+    path = node.get_full_path()
+    if any(exc.match(path) for exc in excludelist):
+        logmsg(2, "curbing "+path)
+        return True
 
     uncurbed_children = []
     for ch in node.children:
@@ -308,13 +398,16 @@ def ask(msg):
         return input(msg+" [Enter,y,Y / n]") in ['', 'y', 'Y']
 
 
-def fullpath(metadata):
+@functools.lru_cache(maxsize=None)
+def fullpath(u):
+    """
+    full path of the document identified by its uuid; memoized, as siblings share their parents' paths
+    """
+    metadata = metadata_by_uuid[u]
     if ("parent" not in metadata) or (metadata["parent"] == ""):
         return "/" + metadata["visibleName"]
     else:
-        parent_uuid = metadata["parent"]
-        parent = metadata_by_uuid[parent_uuid]
-        return fullpath(parent) + "/" + metadata["visibleName"]
+        return fullpath(metadata["parent"]) + "/" + metadata["visibleName"]
 
 
 #################################
@@ -326,7 +419,7 @@ def fullpath(metadata):
 
 class Node:
 
-    def __init__(self, name, parent=None):
+    def __init__(self, name, parent=None, known_id=None):
 
         self.name = name
         self.parent = parent
@@ -334,7 +427,19 @@ class Node:
 
         self.gets_modified = False
 
+        # parents are always constructed before their children
+        if parent is None:
+            self._full_path = name
+        else:
+            self._full_path = parent._full_path + '/' + name
+
         # now retrieve the document ID for this document if it already exists
+        if known_id is not None:
+            # already known from the device, no need to look it up
+            self.id = known_id
+            self.exists = True
+            return
+
         if parent is None:
             metadata = get_metadata_by_name_and_parent(self.name, "")
         else:
@@ -353,6 +458,14 @@ class Node:
         return self.get_full_path()
 
 
+    @classmethod
+    def _from_metadata(cls, known_id, metadata, parent):
+        """
+        constructs a node for an entry that was already retrieved from the device
+        """
+        return cls(metadata['visibleName'], parent=parent, known_id=known_id)
+
+
     def add_child(self, node):
         """
         add a child to this Node and make sure it has a parent set
@@ -364,10 +477,7 @@ class Node:
 
 
     def get_full_path(self):
-        if self.parent is None:
-            return self.name
-        else:
-            return self.parent.get_full_path() + '/' + self.name
+        return self._full_path
 
 
     def render_common(self, prepdir):
@@ -385,15 +495,16 @@ class Node:
                 metadata = construct_metadata(self.filetype, self.name, parent_id=self.parent.id)
             else:
                 metadata = construct_metadata(self.filetype, self.name)
-            json.dump(metadata, f, indent=4)
+            f.write(json.dumps(metadata, separators=(',', ':')))
 
         with open(f'{prepdir}/{self.id}.content', 'w') as f:
-            json.dump({}, f, indent=4)
+            f.write(json.dumps({}, separators=(',', ':')))
 
 
-    def render(self, prepdir):
+    def render(self, prepdir, executor):
         """
         This renders the given note, including DocumentType specifics;
+        file copies are submitted to the executor and the list of pending futures is returned;
         needs to be reimplemented by the subclasses
         """
         raise Exception("Rendering not implemented")
@@ -407,35 +518,54 @@ class Node:
         raise Exception("Not implemented")
 
 
-    def download(self, targetdir=pathlib.Path.cwd()):
+    def download(self, targetdir, executor):
         """
-        retrieve document node from the remarkable to local system
+        retrieve document node from the remarkable to local system;
+        transfers are submitted to the executor and the list of pending futures is returned
         """
         raise Exception("Not implemented")
 
 
 class Document(Node):
 
-    def __init__(self, document, parent=None):
+    def __init__(self, document, parent=None, known_id=None):
 
         self.doc = pathlib.Path(document)
         self.doctype = 'DocumentType'
         self.filetype = self.doc.suffix[1:] if self.doc.suffix.startswith('.') else self.doc.suffix
 
-        super().__init__(self.doc.name, parent=parent)
+        super().__init__(self.doc.name, parent=parent, known_id=known_id)
+
+
+    @classmethod
+    def _from_metadata(cls, known_id, metadata, parent):
+        """
+        constructs a node for a document that was already retrieved from the device
+        """
+        name = metadata['visibleName']
+        if not name.endswith('.pdf'):
+            name += '.pdf'
+        return cls(name, parent=parent, known_id=known_id)
 
 
-    def render(self, prepdir):
+    def render(self, prepdir, executor):
         """
         renders an actual DocumentType tree node
         """
         if not self.exists:
+            return [executor.submit(self.render_document, prepdir)]
+        return []
 
-            self.render_common(prepdir)
 
-            os.makedirs(f'{prepdir}/{self.id}')
-            os.makedirs(f'{prepdir}/{self.id}.thumbnails')
-            shutil.copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}')
+    def render_document(self, prepdir):
+        """
+        writes the files of this document; runs on a worker thread
+        """
+        self.render_common(prepdir)
+
+        os.makedirs(f'{prepdir}/{self.id}')
+        os.makedirs(f'{prepdir}/{self.id}.thumbnails')
+        shutil.copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}')
 
 
     def build(self):
@@ -447,52 +577,57 @@ class Document(Node):
         return
 
 
-    def download(self, targetdir=pathlib.Path.cwd()):
+    def download(self, targetdir, executor):
         """
         retrieve document node from the remarkable to local system
         """
         if args.dryrun:
             print("downloading document to", targetdir/self.name)
-        else:
+            return []
+        return [executor.submit(self.fetch, targetdir)]
 
-            logmsg(1, "retrieving " + self.get_full_path())
-            os.chdir(targetdir)
-
-            # documents we need to actually download
-            filename = self.name if self.name.lower().endswith('.pdf') else f'{self.name}.pdf'
-            if os.path.exists(filename):
-                if if_exists == "skip":
-                    logmsg(0, f"File {filename} already exists, skipping")
-                elif if_exists == "overwrite":
-                    try:
-                        resp = urllib.request.urlopen(f'http://{args.host}/download/{self.id}/placeholder')
-                        with open(filename, 'wb') as f:
-                            f.write(resp.read())
-                    except urllib.error.URLError as e:
-                        print(f"{e.reason}: Is the web interface enabled? (Settings > Storage > USB web interface)")
-                        sys.exit(2)
-                else:
-                    raise Exception("huh?")
-        pass
+
+    def fetch(self, targetdir):
+        """
+        downloads this document via the web interface; runs on a worker thread
+        """
+        logmsg(1, "retrieving " + self.get_full_path())
+
+        # documents we need to actually download
+        filename = self.name if self.name.lower().endswith('.pdf') else f'{self.name}.pdf'
+        if os.path.exists(targetdir/filename) and args.if_exists == "skip":
+            logmsg(0, f"File {filename} already exists, skipping")
+            return
+
+        # errors are raised to the caller, which reports them once for all workers
+        with session.get(f'http://{args.host}/download/{self.id}/placeholder', stream=True) as resp:
+            resp.raise_for_status()
+            with open(targetdir/filename, 'wb') as f:
+                # iter_content undoes any Content-Encoding, unlike reading resp.raw
+                for chunk in resp.iter_content(chunk_size=1 << 16):
+                    f.write(chunk)
 
 
 class Folder(Node):
 
-    def __init__(self, name, parent=None):
+    def __init__(self, name, parent=None, known_id=None):
         self.doctype  = 'CollectionType'
         self.filetype = 'folder'
-        super().__init__(name, parent=parent)
+        super().__init__(name, parent=parent, known_id=known_id)
 
 
-    def render(self, prepdir):
+    def render(self, prepdir, executor):
         """
         renders a folder tree node
         """
+        # folders are rendered right away so that their ids are known to their children
         if not self.exists:
             self.render_common(prepdir)
 
+        futures = []
         for ch in self.children:
-            ch.render(prepdir)
+            futures.extend(ch.render(prepdir, executor))
+        return futures
 
 
     def build(self):
@@ -500,49 +635,41 @@ class Folder(Node):
         This creates a document tree for all nodes that are direct and indirect
         descendants of this node.
         """
-        for uuid, metadata in get_metadata_by_parent(self.id).items():
+        for u, metadata in get_metadata_by_parent(self.id).items():
             if metadata['type'] == "CollectionType":
-                ch = Folder(metadata['visibleName'], parent=self)
+                ch = Folder._from_metadata(u, metadata, self)
             else:
-                name = metadata['visibleName']
-                if not name.endswith('.pdf'):
-                    name += '.pdf'
-                ch = Document(name, parent=self)
+                ch = Document._from_metadata(u, metadata, self)
 
-            ch.id = uuid
             self.add_child(ch)
             ch.build()
 
 
-    def download(self, targetdir=pathlib.Path.cwd()):
+    def download(self, targetdir, executor):
         """
         retrieve document node from the remarkable to local system
         """
         if args.dryrun:
             # folders we simply create ourselves
             print("creating directory", targetdir/self.name)
-            for ch in self.children:
-                ch.download(targetdir/self.name)
         else:
 
             logmsg(1, "retrieving " + self.get_full_path())
-            os.chdir(targetdir)
 
             # folders we simply create ourselves
-            os.makedirs(self.name, exist_ok=True)
+            os.makedirs(targetdir/self.name, exist_ok=True)
 
-            for ch in self.children:
-                ch.download(targetdir/self.name)
+        futures = []
+        for ch in self.children:
+            futures.extend(ch.download(targetdir/self.name, executor))
+        return futures
 
 
 def get_toplevel_files():
     """
-    get a list of all documents in the toplevel My files drawer
+    iterate over the names of all documents in the toplevel My files drawer
     """
-    toplevel_files = []
-    for u, md in get_metadata_by_parent(""):
-        toplevel_files.append(md['visibleName'])
-    return toplevel_files
+    return (md['visibleName'] for md in get_metadata_by_parent("").values())
 
 
 
@@ -563,55 +690,62 @@ size = shutil.get_terminal_size()
 columns = size.columns
 lines   = size.lines
 
+# (colored note, visible length) for each state a node can be in
+note_modified = (colored(" | !!! gets modified !!!", 'red'), len(" | !!! gets modified !!!"))
+note_exists   = (colored(" | exists already", 'green'),      len(" | exists already"))
+note_upload   = (" | upload",                                len(" | upload"))
+
 # just print a filesystem tree for the remarkable representation of what we are going to create
-def print_tree(node, padding):
+def print_tree(node, padding=""):
     """
     prints a filesystem representation of the constructed document tree,
     including a note if the according node already exists on the remarkable or not
     """
-    if node.gets_modified:
-        note = " | !!! gets modified !!!"
-        notelen = len(note)
-        note = colored(note, 'red')
-    elif node.exists:
-        note = " | exists already"
-        notelen = len(note)
-        note = colored(note, 'green')
-    else:
-        note = " | upload"
-        notelen = len(note)
+    stack = [(node, padding)]
+    while stack:
+        node, padding = stack.pop()
+        if node.gets_modified:
+            note, notelen = note_modified
+        elif node.exists:
+            note, notelen = note_exists
+        else:
+            note, notelen = note_upload
 
-    line = padding + node.name
-    if len(line) > columns-notelen:
-        line = line[:columns-notelen-3] + "..."
-    line = line.ljust(columns-notelen)
-    print(line+note)
+        line = padding + node.name
+        if len(line) > columns-notelen:
+            line = line[:columns-notelen-3] + "..."
+        line = line.ljust(columns-notelen)
+        print(line+note)
 
-    for ch in node.children:
-        print_tree(ch, padding+"  ")
+        # reversed, so that the children are popped in their original order
+        stack.extend((ch, padding+"  ") for ch in reversed(node.children))
 
 
-def construct_node_tree_from_disk(basepath, parent=None):
+def construct_node_tree_from_disk(basepath, parent=None, entry=None):
     """
     this recursively constructs the document tree based on the top-level
-    document/folder data structure on disk that we put in initially
+    document/folder data structure on disk that we put in initially;
+    entry is the os.DirEntry of basepath when it was found by scanning its parent
     """
     if args.verbosity >= 1:
         print(f"scanning {basepath}")
     path = pathlib.Path(basepath)
-    if path.is_dir():
+    # a DirEntry answers is_dir/is_file from the directory scan, a Path needs a stat for each
+    stat_source = path if entry is None else entry
+    if stat_source.is_dir():
         node = Folder(path.name, parent=parent)
-        for f in os.listdir(path):
-            child = construct_node_tree_from_disk(path/f, parent=node)
-            if child is not None:
-                node.add_child(child)
+        with os.scandir(path) as it:
+            for ch_entry in it:
+                child = construct_node_tree_from_disk(ch_entry.path, parent=node, entry=ch_entry)
+                if child is not None:
+                    node.add_child(child)
         if not node.children:
             print(f"empty directory, ignored: {path}")
             return None
         else:
             return node
 
-    elif path.is_file() and path.suffix.lower() in ['.pdf', '.epub']:
+    elif stat_source.is_file() and path.suffix.lower() in ['.pdf', '.epub']:
         node = Document(path, parent=parent)
         if node.exists:
             if args.if_exists == "skip":
@@ -630,7 +764,7 @@ def construct_node_tree_from_disk(basepath, parent=None):
                 # if we only want to overwrite the document file itself, but keep everything else,
                 # we simply switch out the render function of this node to a simple document copy
                 # might mess with xochitl's thumbnail-generation and other things, but overall seems to be fine
-                node.render = lambda self, prepdir: shutil.copy(self.doc, f'{prepdir}/{self.id}.{self.filetype}')
+                node.render = lambda prepdir, executor: [executor.submit(shutil.copy, node.doc, f'{prepdir}/{node.id}.{node.filetype}')]
 
             elif args.if_exists == "duplicate":
                 # if we don't skip existing files, this file gets a new document ID
@@ -681,9 +815,10 @@ def push_to_remarkable():
                 root.append(node)
 
     # apply excludes
+    excludes = [re.compile(p) for p in args.exclude_patterns]
     curbed_roots = []
     for r in root:
-        if not curb_tree(r, args.exclude_patterns):
+        if not curb_tree(r, excludes):
             curbed_roots.append(r)
 
     root = curbed_roots
@@ -697,21 +832,28 @@ def push_to_remarkable():
     try:
         if not args.dryrun:
             print(f"preparing the files to copy")
-            for r in root:
-                r.render(args.prepdir)
+            # copying the documents is I/O bound, so it is spread over a thread pool
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1)*4)) as executor:
+                futures = []
+                for r in root:
+                    futures.extend(r.render(args.prepdir, executor))
+                for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                    future.result()
 
             if args.debug:
                 print(f' --> Payload data can be found in {args.prepdir}')
                 return
 
-        command = f'rsync -a --info=progress2 -e "{ssh_command}" '
+        rsh = " ".join(shlex.quote(c) for c in ssh_command)
+        # the small json files compress well, the documents themselves are already compressed
+        command = ['rsync', '-az', '--skip-compress=pdf/epub', '--info=progress2', '-e', rsh]
         if args.dryrun:
-            command += " -n "
+            command.append('-n')
         if args.if_does_not_exist == "delete":
-            command += " --delete "
-        command += f' {args.prepdir}/ {args.host}:{xochitl_dir}/ ' # note: the last / is important
-        print(f"running: {command}")
-        subprocess.run(command, shell=True, check=True)
+            command.append('--delete')
+        command += [f'{args.prepdir}/', f'{args.host}:{xochitl_dir}/'] # note: the last / is important
+        print(f"running: {' '.join(shlex.quote(c) for c in command)}")
+        subprocess.run(command, check=True)
 
         if not args.dryrun:
             ssh(f'systemctl restart xochitl')
@@ -748,24 +890,68 @@ def pull_from_remarkable():
                 local_anchor.add_child(new_node)
                 local_anchor = new_node
 
-        metadata = get_metadata_by_name(target)
-        if metadata is not None:
+        # names are unique per parent, so this resolves to a single entry
+        found = get_metadata_by_name_and_parent(target, "" if local_anchor is None else local_anchor.id)
+        if found is not None:
+            u, metadata = found
             if metadata['type'] == 'DocumentType':
-                new_node = Document(target, parent=local_anchor)
+                new_node = Document._from_metadata(u, metadata, local_anchor)
             else:
-                new_node = Folder(target, parent=local_anchor)
+                new_node = Folder._from_metadata(u, metadata, local_anchor)
             anchors.append(new_node)
         else:
             print(f"Cannot find {doc}, skipping")
 
 
-    for a in anchors:
-        a.build()
-        if not curb_tree(a, args.exclude_patterns):
-            a.download(targetdir=destination_directory)
+    excludes = [re.compile(p) for p in args.exclude_patterns]
+    # the folders are created right away, the documents are downloaded concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = []
+        for a in anchors:
+            a.build()
+            if not curb_tree(a, excludes):
+                futures.extend(a.download(destination_directory, executor))
+        try:
+            for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                future.result()
+        except requests.exceptions.RequestException as e:
+            # do not start the downloads that are still queued
+            for future in futures:
+                future.cancel()
+            print(f"{e}: Is the web interface enabled? (Settings > Storage > USB web interface)")
+            sys.exit(2)
+
+
+def scan_device():
+    """
+    lists the files on the device and computes the md5sum of each document, all in a single round trip;
+    returns the list of file names and the lines of md5sum output
+    """
+    # pdfs and epubs are hashed; the sums are cached in .md5sum.cache; only the files that are new to the cache or
+    # modified since the last run (.md5sum.stamp) are hashed, two at a time.
+    # the cache is then compacted to the latest sum of each file that still exists.
+    # each output line is tagged with F (file name) or M (md5sum).
+    # the whole scan is guarded by the cd: run anywhere else, it would list and hash (and offer to delete) the wrong files
+    results = ssh((f"cd {xochitl_dir} && {{ "
+                   "ls -1 | sed \"s/^/F /\" ; "
+                   "touch .md5sum.cache .md5sum.stamp.new ; "
+                   "awk \"{ print \\$2 }\" .md5sum.cache > .md5sum.known ; "
+                   "{ if [ -e .md5sum.stamp ] ; then find . -maxdepth 1 \\( -name \"*.pdf\" -o -name \"*.epub\" \\) -newer .md5sum.stamp ; fi ; "
+                   "find . -maxdepth 1 \\( -name \"*.pdf\" -o -name \"*.epub\" \\) | grep -vxFf .md5sum.known ; } "
+                   "| sort -u | xargs -r -P 2 -n 4 md5sum >> .md5sum.cache ; "
+                   "mv .md5sum.stamp.new .md5sum.stamp ; "
+                   "awk \"{ s[\\$2] = \\$1 } END { for (f in s) print s[f], f }\" .md5sum.cache "
+                   "| while read s f ; do if [ -e \"$f\" ] ; then echo \"$s  $f\" ; fi ; done > .md5sum.cache.new ; "
+                   "mv .md5sum.cache.new .md5sum.cache ; "
+                   "rm .md5sum.known ; "
+                   "sed \"s/^/M /\" .md5sum.cache ; }")).split("\n")
+    files = [line[2:] for line in results if line.startswith("F ")]
+    md5sums = [line[2:] for line in results if line.startswith("M ")]
+    return files, md5sums
 
 
 def cleanup_deleted():
+    """returns the uuids of the deleted files to remove"""
     print("removing trash files")
 
     deleted_uuids = []
@@ -776,53 +962,56 @@ def cleanup_deleted():
 
     if len(deleted_uuids) == 0:
         print('No deleted files found.')
-        return False
+        return []
     else:
         if ask(f'Clean up {len(deleted_uuids)} deleted files?'):
-            ssh(f"rm -r {xochitl_dir}/{{{','.join(deleted_uuids)}}}*", dry=args.dryrun)
-            return True
+            return deleted_uuids
         else:
-            return False
+            return []
 
 
-def cleanup_orphaned():
+def cleanup_orphaned(files):
+    """returns the names of the files without metadata to remove"""
     print("removing files without metadata")
-    files = ssh(f"ls -1 {xochitl_dir} | while read f ; do stem=${{f%%.*}} ; if ! [ -e {xochitl_dir}/$stem.metadata ] ; then echo $f ; fi ; done")
-    l = len(files.split("\n"))
-    if l == 1:
+    stems = {f[:-len(".metadata")] for f in files if f.endswith(".metadata")}
+    orphans = [f for f in files if f.split(".", 1)[0] not in stems]
+    if len(orphans) == 0:
         print('No orphan files found.')
-    elif args.dryrun:
-        if args.verbosity >= 1:
-            print(files)
+        return []
+    if args.verbosity >= 1:
+        print("\n".join(orphans))
+    if ask(f'Clean up {len(orphans)} orphaned files?'):
+        return orphans
     else:
-        if args.verbosity >= 1:
-            print(files)
-        if ask(f'Clean up {l-1} orphaned files?'):
-            ssh(f"ls -1 {xochitl_dir} | while read f ; do stem=${{f%%.*}} ; if ! [ -e {xochitl_dir}/$stem.metadata ] ; then rm {xochitl_dir}/$f ; fi ; done")
-
-
-def cleanup_duplicates():
-    """detect, select, remove duplicates. If there are notes, merge them."""
-
-    print("computing md5sum of each file on the reMarkable device... it takes some time in the first run.")
-    results = ssh((f"for f in {xochitl_dir}/*.pdf ; do "
-                   "if [ ! -e $f.md5sum ] ; then "
-                   "md5sum $f > $f.md5sum ;"
-                   "fi ;"
-                   "done ;"
-                   f"cat {xochitl_dir}/*.md5sum")).split("\n")
+        return []
+
+
+def cleanup_duplicates(results):
+    """detect and select duplicates, returns the uuids of those to remove. If there are notes, merge them."""
+
     database = dict()
     duplicates = set()
     for line in results:
+        if not line:
+            continue
         try:
             md5, filename = line.split()
         except Exception as e:
             print(line)
             raise e
         u = os.path.basename(os.path.splitext(filename)[0])
+        metadata = get_metadata_by_uuid(u)
+        if metadata is None:
+            # trashed or without metadata, nothing to choose from
+            continue
+        try:
+            lastmodified = int(metadata.get("lastModified", 0))
+        except ValueError as e:
+            print(f"error while reading the last modified date of file {fullpath(u)}")
+            raise e
         if md5 not in database:
             database[md5] = []
-        database[md5].append(u)
+        database[md5].append((lastmodified, u, metadata))
         if len(database[md5])>=2:
             duplicates.add(md5)
 
@@ -831,22 +1020,11 @@ def cleanup_duplicates():
     for j, md5 in enumerate(duplicates):
         print(f"({j:3d}/{len(duplicates)}) found {len(database[md5])} duplicates for md5sum {md5}:")
         try:
-            tmp = []
-
-            for u in database[md5]:
-                metadata = get_metadata_by_uuid(u)
-                if metadata is None:
-                    print(f"weird, the metadata for {u} does not exist, skipping (in: {database[md5]})")
-                    continue
-                lastmodified = metadata["lastModified"]
-                try:
-                    lastmodified = int(lastmodified)
-                except ValueError as e:
-                    print(f"error while reading the last modified date of file {fullpath(metadata)}")
-                    raise e
-                tmp.append((lastmodified, u, metadata))
-
-            tmp = sorted(tmp,reverse=True)
+            # a document may have been removed already through the sum of its other file (pdf/epub)
+            tmp = sorted((entry for entry in database[md5] if entry[1] in metadata_by_uuid), reverse=True)
+            if len(tmp) < 2:
+                print("already handled.")
+                continue
 
             for i, (lastmodified, u, metadata) in enumerate(tmp):
                 lastmodified = datetime.datetime.fromtimestamp(lastmodified//1000)
@@ -854,7 +1032,7 @@ def cleanup_duplicates():
                     prefix="(* newest)"
                 else:
                     prefix="          "
-                print(f"{prefix} {i}, uuid {u}, modified {lastmodified}, {fullpath(metadata)}")
+                print(f"{prefix} {i}, uuid {u}, modified {lastmodified}, {fullpath(u)}")
 
         except KeyError:
             print("this should not happen...")
@@ -900,61 +1078,85 @@ def cleanup_duplicates():
             if u == keep:
                 continue
             remove_uuid(u)
-            ssh(f"rm -rv {xochitl_dir}/{u}*", dry=args.dryrun)
             deleted_uuids.append(u)
         print(f'Removed {len(tmp)-1} duplicates.')
 
 
     print(f'Removed {len(deleted_uuids)} duplicates in total.')
-    return len(deleted_uuids) > 0
+    return deleted_uuids
 
 
 def cleanup_emptydir():
-    """remove empty directory"""
+    """detect empty directories, returns the uuids of those to remove"""
 
     deleted_uuids = []
-    empty_found = True
+    # the first iteration checks every folder, the later ones only the parents of the folders just removed
+    candidates = [u for u, metadata in metadata_by_uuid.items() if metadata['type'] == "CollectionType"]
     iteration = 1
-    while empty_found:
+    while candidates:
         print(f"iteration {iteration}")
         iteration += 1
-        empty_found = False
         _deleted_uuids = []
-        for u, metadata in metadata_by_uuid.items():
-            if metadata['type'] != "CollectionType":
-                continue
+        for u in candidates:
             if u not in metadata_by_parent:
-                print(f"empty: {fullpath(metadata)}")
+                print(f"empty: {fullpath(u)}")
                 _deleted_uuids.append(u)
-                empty_found = True
         # do not remove entries within a loop !
+        parents = dict()
         for u in _deleted_uuids:
+            parent = metadata_by_uuid[u].get("parent", "")
             remove_uuid(u)
+            if parent in metadata_by_uuid:
+                parents[parent] = None
+        candidates = list(parents)
         deleted_uuids.extend(_deleted_uuids)
 
     if len(deleted_uuids) == 0:
         print('No empty directories found.')
-        return False
+        return []
     else:
         if ask(f'Clean up {len(deleted_uuids)} empty directories?'):
-            ssh(f"rm -r {xochitl_dir}/{{{','.join(deleted_uuids)}}}*", dry=args.dryrun)
-            return True
+            return deleted_uuids
         else:
-            return False
+            return []
+
 
+# the background device scan of the clean mode, if any
+scan = None
 
-ssh_connection = None
 try:
 
-    ssh_connection = subprocess.Popen(f'{ssh_command} {args.host} -M -N -q ', shell=True)
+    # the device may need a moment (e.g. right after an update or a reboot), so retry with a growing delay
+    for attempt, delay in enumerate((0, 1, 3), 1):
+        time.sleep(delay)
+
+        # open the master connection once in the background; every later ssh/rsync call
+        # multiplexes over its socket instead of doing its own handshake
+        subprocess.run([*ssh_command, args.host, '-fN'])
+
+        # quickly check if we actually have a functional ssh connection;
+        # asking the master over its socket needs no round trip to the device
+        try:
+            check = subprocess.run([*ssh_command, args.host, '-O', 'check'], capture_output=True, text=True, timeout=5)
+            status, checkmsg = check.returncode, check.stderr.strip()
+        except subprocess.TimeoutExpired:
+            status, checkmsg = 255, "timed out while checking the master connection"
+        if status == 0:
+            break
+        print(f"ssh connection attempt {attempt} failed: {checkmsg}")
 
-    # quickly check if we actually have a functional ssh connection (might not be the case right after an update)
-    status, checkmsg = ssh("/bin/true",status=True)
     if status != 0:
         print("ssh connection does not work, verify that you can manually ssh into your reMarkable. ssh itself commented the situation with:")
         print("msg:",checkmsg)
         sys.exit(255)
 
+    if args.mode == 'clean':
+        # the device scan (hashing) does not depend on the metadata, so it runs in the background meanwhile
+        print("scanning the device and computing md5sum of each document... it takes some time in the first run.")
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        scan = executor.submit(scan_device)
+        executor.shutdown(wait=False)
+
     retrieve_metadata()
     if args.mode == 'push':
         push_to_remarkable()
@@ -964,15 +1166,31 @@ try:
         args.documents = get_toplevel_files()
         pull_from_remarkable()
     elif args.mode == 'clean':
-        r1 = cleanup_deleted()
-        cleanup_orphaned()
-        r2 = cleanup_duplicates()
-        r3 = cleanup_emptydir()
-        if not args.dryrun and (r1 or r2 or r3):
-            ssh(f'systemctl restart xochitl')
+        # one round trip to inspect the device, the passes decide locally,
+        # and everything they selected is removed at once
+        uuids = cleanup_deleted()
+
+        files, md5sums = scan.result()
+        # the listing tells the exact files of each document, the device does not need to glob for them
+        files_by_uuid = collections.defaultdict(list)
+        for f in files:
+            files_by_uuid[f.split(".", 1)[0]].append(f)
+
+        removals = cleanup_orphaned(files)
+        uuids += cleanup_duplicates(md5sums)
+        uuids += cleanup_emptydir()
+        removals += [f for u in uuids for f in files_by_uuid.get(u, [])]
+        if removals:
+            remove_remote(removals, restart=True)
 
 finally:
-    if ssh_connection is not None:
-        print("terminating ssh connection")
-        ssh_connection.terminate()
+    if scan is not None and not scan.cancel():
+        # the scan still uses the master connection, it has to finish before the master is shut down
+        concurrent.futures.wait([scan])
+    print("terminating ssh connection")
+    try:
+        subprocess.run([*ssh_command, args.host, '-O', 'exit'], capture_output=True, timeout=2)
+    except subprocess.TimeoutExpired:
+        # not worth waiting for, the master exits by itself once ControlPersist runs out
+        print("ssh master did not respond, leaving it to time out")
 